@@ -8,6 +8,8 @@ import numpy as np
 import torch
 from torch import nn
 
+from .utils import fp32_linear
+
 class GaussLayer(nn.Module):
     '''
         Drop in replacement for SineLayer but with Gaussian non linearity
@@ -25,6 +27,8 @@ class GaussLayer(nn.Module):
         self.linear = nn.Linear(in_features, out_features, bias=bias)
         
     def forward(self, input):
+        if self.is_first:
+            return torch.exp(-(self.scale*fp32_linear(self.linear, input))**2)
         return torch.exp(-(self.scale*self.linear(input))**2)
     
 
@@ -28,8 +28,11 @@ class GaborLayer(nn.Module):
         #self.bias = nn.Parameter(torch.zeros(self.responses)) if bias else None
 
     def forward(self, input):
-        norm = (input ** 2).sum(dim=1).unsqueeze(-1) + (self.mu ** 2).sum(dim=1).unsqueeze(0) - 2 * input @ self.mu.T
-        return torch.exp(- self.gamma.unsqueeze(0) / 2. * norm) * torch.sin(self.linear(input))
+        # Every filter sees the raw coordinates, so keep it out of autocast
+        with torch.autocast(device_type=input.device.type, enabled=False):
+            input = input.float()
+            norm = (input ** 2).sum(dim=1).unsqueeze(-1) + (self.mu ** 2).sum(dim=1).unsqueeze(0) - 2 * input @ self.mu.T
+            return torch.exp(- self.gamma.unsqueeze(0) / 2. * norm) * torch.sin(self.linear(input))
 
 
 class INR(nn.Module):
@@ -8,7 +8,7 @@ import numpy as np
 import torch
 from torch import nn
 
-from .utils import build_montage, normalize
+from .utils import build_montage, normalize, fp32_linear
     
 class ReLULayer(nn.Module):
     '''
@@ -26,6 +26,8 @@ class ReLULayer(nn.Module):
         self.linear = nn.Linear(in_features, out_features, bias=bias)
         
     def forward(self, input):
+        if self.is_first:
+            return nn.functional.relu(fp32_linear(self.linear, input))
         return nn.functional.relu(self.linear(input))
     
 class PosEncoding(nn.Module):
@@ -8,7 +8,7 @@ import numpy as np
 import torch
 from torch import nn
 
-from .utils import build_montage, normalize
+from .utils import build_montage, normalize, fp32_linear
     
 class SineLayer(nn.Module):
     '''
@@ -46,6 +46,8 @@ class SineLayer(nn.Module):
                                              np.sqrt(6 / self.in_features) / self.omega_0)
         
     def forward(self, input):
+        if self.is_first:
+            return torch.sin(self.omega_0 * fp32_linear(self.linear, input))
         return torch.sin(self.omega_0 * self.linear(input))
     
 class INR(nn.Module):
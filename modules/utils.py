@@ -93,21 +93,19 @@ def measure(x, noise_snr=40, tau=100):
         Outputs:
             x_meas: x with added noise
     '''
-    x_meas = np.copy(x)
+    rng = np.random.default_rng()
 
-    noise = np.random.randn(x_meas.size).reshape(x_meas.shape)*noise_snr
+    noise = rng.standard_normal(x.shape)*noise_snr
 
-    # First add photon noise, provided it is not infinity
+    # First add photon noise, provided it is not infinity. Negative values
+    # get negated Poisson noise, done in one pass over the whole array
     if tau != float('Inf'):
-        x_meas = x_meas*tau
-
-        x_meas[x > 0] = np.random.poisson(x_meas[x > 0])
-        x_meas[x <= 0] = -np.random.poisson(-x_meas[x <= 0])
+        x_meas = np.sign(x)*rng.poisson(np.abs(x)*tau)
 
         x_meas = (x_meas + noise)/tau
 
     else:
-        x_meas = x_meas + noise
+        x_meas = x + noise
 
     return x_meas
 
@@ -141,22 +139,46 @@ def build_montage(images):
 def count_parameters(model):
     return sum(p.numel() for p in model.parameters() if p.requires_grad)
 
-def get_coords(H, W, T=None):
+def fp32_linear(linear, x):
+    '''
+        Apply a linear layer in fp32, even inside an autocast region. Used by
+        the layers that take raw coordinates, since bf16 spacing near 1 is
+        as coarse as the pixel pitch of a 512 wide grid.
+
+        Inputs:
+            linear: nn.Linear module
+            x: Input tensor
+
+        Outputs:
+            y: linear(x) computed in fp32
+    '''
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        return linear(x.float())
+
+def get_coords(H, W, T=None, device='cpu'):
     '''
         Get 2D/3D coordinates
+
+        Inputs:
+            H, W, T: Grid size. If T is None, 2D coordinates are returned
+            device: Device to build the coordinates on
+
+        Outputs:
+            coords: (H*W, 2) or (H*W*T, 3) float32 tensor of coordinates in
+                [-1, 1], ordered to match an (H, W, T) array reshaped to 1D
     '''
+    y = torch.linspace(-1, 1, H, device=device)
+    x = torch.linspace(-1, 1, W, device=device)
+
     if T is None:
-        X, Y = np.meshgrid(np.linspace(-1, 1, W), np.linspace(-1, 1, H))
-        coords = np.hstack((X.reshape(-1, 1), Y.reshape(-1, 1)))
+        Y, X = torch.meshgrid(y, x, indexing='ij')
+        coords = torch.stack((X, Y), dim=-1).reshape(-1, 2)
     else:
-        X, Y, Z = np.meshgrid(np.linspace(-1, 1, W),
-                              np.linspace(-1, 1, H),
-                              np.linspace(-1, 1, T))
-        coords = np.hstack((X.reshape(-1, 1),
-                            Y.reshape(-1, 1),
-                            Z.reshape(-1, 1)))
+        z = torch.linspace(-1, 1, T, device=device)
+        Y, X, Z = torch.meshgrid(y, x, z, indexing='ij')
+        coords = torch.stack((X, Y, Z), dim=-1).reshape(-1, 3)
     
-    return torch.tensor(coords.astype(np.float32))
+    return coords
 
 def resize(cube, scale):
     '''
@@ -11,6 +11,8 @@ from torch import nn
 
 import torch.nn.functional as F
 
+from .utils import fp32_linear
+
 class RealGaborLayer(nn.Module):
     '''
         Implicit representation with Gabor nonlinearity
@@ -84,7 +86,10 @@ class ComplexGaborLayer(nn.Module):
                                 dtype=dtype)
     
     def forward(self, input):
-        lin = self.linear(input)
+        if self.is_first:
+            lin = fp32_linear(self.linear, input)
+        else:
+            lin = self.linear(input)
         omega = self.omega_0 * lin
         scale = self.scale_0 * lin
         
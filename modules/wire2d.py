@@ -11,6 +11,8 @@ from torch import nn
 
 import torch.nn.functional as F
 
+from .utils import fp32_linear
+
 class ComplexGaborLayer2D(nn.Module):
     '''
         Implicit representation with complex Gabor nonlinearity with 2D activation function
@@ -57,10 +59,14 @@ class ComplexGaborLayer2D(nn.Module):
                                     dtype=dtype)
     
     def forward(self, input):
-        lin = self.linear(input)
+        if self.is_first:
+            lin = fp32_linear(self.linear, input)
+            scale_y = fp32_linear(self.scale_orth, input)
+        else:
+            lin = self.linear(input)
+            scale_y = self.scale_orth(input)
         
         scale_x = lin
-        scale_y = self.scale_orth(input)
         
         freq_term = torch.exp(1j*self.omega_0*lin)
         
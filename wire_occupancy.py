@@ -4,23 +4,28 @@ import os
 import sys
 import tqdm
 import time
-import copy
 import wandb
 from dotenv import load_dotenv
 load_dotenv()
 
+# Expandable segments reduce allocator fragmentation; set before any CUDA use
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF", "expandable_segments:True,max_split_size_mb:512"
+)
+
 import numpy as np
 from scipy import io
 from scipy import ndimage
 import cv2
-import tripy
-import numpy as np
-from plyfile import PlyData, PlyElement
-import scipy.io
 
 import torch
 from torch.optim.lr_scheduler import LambdaLR
 
+# Allow TF32 tensor cores for the MLP matmuls
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+
 import matplotlib.pyplot as plt
 
 plt.gray()
@@ -30,6 +35,7 @@ from modules import utils
 from modules import volutils
 
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Occupancy parameters")
@@ -59,6 +65,7 @@ if __name__ == "__main__":
     hidden_layers = 2  # Number of hidden layers in the mlp
     hidden_features = 256  # Number of hidden units per layer
     maxpoints = int(2e5)  # Batch size
+    display_every = 50  # Epochs between preview refreshes (Windows only)
 
     if os.getenv("WANDB_LOG") in ["true", "True", True]:
         run_name = f'{nonlin}_{expname}_occupancy__{str(time.time()).replace(".", "_")}'
@@ -88,7 +95,10 @@ if __name__ == "__main__":
 
     maxpoints = min(H * W * T, maxpoints)
 
-    imten = torch.tensor(im).cuda().reshape(H * W * T, 1)
+    # Stage the cropped volume straight into pinned memory (one host copy)
+    imten_host = torch.empty(im.shape, pin_memory=True)
+    imten_host.copy_(torch.from_numpy(im))
+    imten = imten_host.to("cuda", non_blocking=True).reshape(H * W * T, 1)
 
     if nonlin == "posenc":
         nonlin = "relu"
@@ -109,6 +119,10 @@ if __name__ == "__main__":
         pos_encode=posencode,
         sidelength=max(H, W, T),
     ).cuda()
+    torch.cuda.empty_cache()
+
+    # Fused training forward pass; parameters are shared with model
+    train_model = torch.compile(model, fullgraph=False)
 
     # Optimizer
     optim = torch.optim.Adam(lr=learning_rate, params=model.parameters())
@@ -119,45 +133,67 @@ if __name__ == "__main__":
     criterion = torch.nn.MSELoss()
 
     # Create inputs
-    coords = utils.get_coords(H, W, T)
+    coords = utils.get_coords(H, W, T, device="cuda")[None, ...]
 
     mse_array = np.zeros(niters)
     time_array = np.zeros(niters)
     best_mse = float("inf")
-    best_img = None
 
     tbar = tqdm.tqdm(range(niters))
 
     im_estim = torch.zeros((H * W * T, 1), device="cuda")
+    best_img = torch.zeros_like(im_estim)
+
+    # Ground truth occupancy mask for the on-device IoU; same convention as
+    # volutils.get_IoU (nonzero ground truth, prediction >= threshold)
+    imten_occ = imten != 0
+
+    # The upload is done with; release the page-locked copy
+    del imten_host
+
+    # Reusable batch buffers for full batches and the ragged final batch
+    batch_sizes = {maxpoints, (H * W * T) % maxpoints} - {0}
+    buf_coords = {n: torch.empty((1, n, 3), device="cuda") for n in batch_sizes}
+    buf_target = {n: torch.empty((n, 1), device="cuda") for n in batch_sizes}
 
     tic = time.time()
     print("Running %s nonlinearity" % nonlin)
     for idx in tbar:
-        indices = torch.randperm(H * W * T)
+        indices = torch.randperm(H * W * T, device="cuda")
 
-        train_loss = 0
+        train_loss = torch.zeros((), device="cuda")
         nchunks = 0
         for b_idx in range(0, H * W * T, maxpoints):
             b_indices = indices[b_idx : min(H * W * T, b_idx + maxpoints)]
-            b_coords = coords[b_indices, ...].cuda()
-            b_indices = b_indices.cuda()
-            pixelvalues = model(b_coords[None, ...]).squeeze()[:, None]
-
-            with torch.no_grad():
-                im_estim[b_indices, :] = pixelvalues
+            nbatch = b_indices.numel()
+            b_coords = torch.index_select(coords, 1, b_indices, out=buf_coords[nbatch])
+            b_target = torch.index_select(imten, 0, b_indices, out=buf_target[nbatch])
+            # bf16 only reaches the real-valued models; WIRE layers are complex
+            with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
+                pixelvalues = train_model(b_coords).squeeze(0)
+                loss = criterion(pixelvalues, b_target)
 
-            loss = criterion(pixelvalues, imten[b_indices, :])
+            im_estim[b_indices, :] = pixelvalues.detach()
 
-            optim.zero_grad()
+            optim.zero_grad(set_to_none=True)
             loss.backward()
             optim.step()
 
-            lossval = loss.item()
-            train_loss += lossval
+            train_loss += loss.detach()
             nchunks += 1
 
+        # Sync with the device once per epoch rather than per batch
+        train_loss = train_loss.item()
+
+        # IoU computed once on the GPU; unlike volutils.get_IoU this does not
+        # binarize im_estim in place
+        estim_occ = im_estim >= mcubes_thres
+        iou = (
+            (estim_occ & imten_occ).sum() / (estim_occ | imten_occ).sum()
+        ).item()
+
         if occupancy:
-            mse_array[idx] = volutils.get_IoU(im_estim, imten, mcubes_thres)
+            mse_array[idx] = iou
         else:
             mse_array[idx] = train_loss / nchunks
 
@@ -165,20 +201,30 @@ if __name__ == "__main__":
             xp.log(
                 {
                     "loss": train_loss / nchunks,
-                    "iou": volutils.get_IoU(im_estim, imten, mcubes_thres),
+                    "iou": iou,
                 }
             )
 
         time_array[idx] = time.time()
         scheduler.step()
 
-        im_estim_vol = im_estim.reshape(H, W, T)
-
-        if lossval < best_mse:
-            best_mse = lossval
-            best_img = copy.deepcopy(im_estim)
-
-        if sys.platform == "win32":
+        # On a new best, evaluate the whole volume in contiguous order so the
+        # saved estimate comes from a single set of weights. As in the
+        # denoising script, the selection loss comes from this epoch's
+        # training batches, while the volume is rebuilt from the weights after
+        # its last optimizer step, so the two are one step apart
+        if train_loss / nchunks < best_mse:
+            best_mse = train_loss / nchunks
+            with torch.no_grad(), torch.autocast(
+                device_type="cuda", dtype=torch.bfloat16
+            ):
+                for b_idx in range(0, H * W * T, maxpoints):
+                    best_img[b_idx : b_idx + maxpoints] = model(
+                        coords[:, b_idx : b_idx + maxpoints, ...]
+                    ).squeeze(0)
+
+        if sys.platform == "win32" and idx % display_every == 0:
+            im_estim_vol = im_estim.reshape(H, W, T)
             cv2.imshow("GT", im[..., idx % T])
             cv2.imshow("Estim", im_estim_vol[..., idx % T].detach().cpu().numpy())
             cv2.waitKey(1)
@@ -189,7 +235,7 @@ if __name__ == "__main__":
     total_time = time.time() - tic
     nparams = utils.count_parameters(model)
 
-    best_img = best_img.reshape(H, W, T).detach().cpu().numpy()
+    best_img = best_img.reshape(H, W, T).cpu().numpy()
 
     if posencode:
         nonlin = "posenc"
@@ -213,38 +259,55 @@ if __name__ == "__main__":
     mat_save_path = os.path.join(
         os.getenv("RESULTS_SAVE_PATH"), f"{expname}_{nonlin}.mat"
     )
-    io.savemat(
-        mat_save_path, mdict
-    )
 
-    # Generate a mesh with marching cubes if it is an occupancy volume
-    if occupancy:
-        volutils.march_and_save(best_img, mcubes_thres, mat_save_path, True)
+    # Blocking file and network I/O runs on a single worker thread, which
+    # keeps the writes to mat_save_path in order
+    with ThreadPoolExecutor(max_workers=1) as saver:
+        jobs = [saver.submit(io.savemat, mat_save_path, mdict)]
 
-    print("Total time %.2f minutes" % (total_time / 60))
-    if occupancy:
-        print("IoU: ", volutils.get_IoU(best_img, im, mcubes_thres))
-    else:
-        print("PSNR: ", utils.psnr(im, best_img))
-    print("Total pararmeters: %.2f million" % (nparams / 1e6))
+        # Generate a mesh with marching cubes if it is an occupancy volume
+        if occupancy:
+            jobs.append(
+                saver.submit(
+                    volutils.march_and_save, best_img, mcubes_thres, mat_save_path, True
+                )
+            )
 
-    # save the model
-    os.makedirs(
-        os.path.join(os.getenv("MODEL_SAVE_PATH"), "occupancy"),
-        exist_ok=True,
-    )
-    torch.save(
-        model.state_dict(),
-        os.path.join(
-            os.getenv("MODEL_SAVE_PATH"),
-            "occupancy",
-            "%s.pth" % nonlin,
-        ),
-    )
+        # save the model
+        os.makedirs(
+            os.path.join(os.getenv("MODEL_SAVE_PATH"), "occupancy"),
+            exist_ok=True,
+        )
+        jobs.append(
+            saver.submit(
+                torch.save,
+                model.state_dict(),
+                os.path.join(
+                    os.getenv("MODEL_SAVE_PATH"),
+                    "occupancy",
+                    "%s.pth" % nonlin,
+                ),
+            )
+        )
+
+        print("saving the mesh on WANDB")
+        jobs.append(saver.submit(np.save, mat_save_path, best_img))
+
+        def log_mesh():
+            artifact = wandb.Artifact('3d_mesh', type='mesh')
+            artifact.add_file(mat_save_path)
+            wandb.log_artifact(artifact)
 
-    print("saving the mesh on WANDB")
-    np.save(mat_save_path, best_img)
+        jobs.append(saver.submit(log_mesh))
+
+        print("Total time %.2f minutes" % (total_time / 60))
+        # get_IoU thresholds its input in place, so hand it a copy that the
+        # saving jobs do not share
+        if occupancy:
+            print("IoU: ", volutils.get_IoU(best_img.copy(), im, mcubes_thres))
+        else:
+            print("PSNR: ", utils.psnr(im, best_img))
+        print("Total pararmeters: %.2f million" % (nparams / 1e6))
 
-    artifact = wandb.Artifact('3d_mesh', type='mesh')
-    artifact.add_file(mat_save_path)
-    wandb.log_artifact(artifact)
+        for job in jobs:
+            job.result()